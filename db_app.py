@@ -1,11 +1,29 @@
 import streamlit as st
-import requests
+import streamlit.components.v1 as components
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+import requests_cache
 import pandas as pd
+import numpy as np
 import plotly.graph_objects as go
+import os
 import sqlite3
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 import pydeck as pdk
+import duckdb
 import urllib3
 
+try:
+    import connectorx as cx
+except ImportError:
+    cx = None
+
 # --- 設定頁面 ---
 st.set_page_config(
     page_title="一週農業氣象預報 (SQLite版)",
@@ -15,6 +33,13 @@ st.set_page_config(
 
 # --- 資料庫設定 ---
 DB_NAME = "data.db"
+# journal_mode=WAL 會寫入資料庫檔，只需在 init_db 設定一次；其餘為連線層級設定
+DB_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-20000",
+    "PRAGMA mmap_size=268435456",
+)
 
 # --- 地區座標對照表 ---
 CITY_MAPPING = [
@@ -41,13 +66,29 @@ CITY_MAPPING = [
     {"city": "金門縣", "region": "金門地區", "lat": 24.4404, "lon": 118.3225},
     {"city": "連江縣", "region": "馬祖地區", "lat": 26.1505, "lon": 119.9590},
 ]
+# 匯入時就轉成欄式 DataFrame，欄名對齊預報資料，地圖分頁直接以地區 join
+CITY_MAPPING_DF = pd.DataFrame(CITY_MAPPING).rename(columns={"city": "顯示名稱", "region": "地區"})
+
+@st.cache_resource
+def get_conn():
+    # 跨 rerun 共用同一條連線，保留 page cache；autocommit 模式，交易由 BEGIN/COMMIT 明確控制
+    conn = sqlite3.connect(DB_NAME, check_same_thread=False, isolation_level=None)
+    for pragma in DB_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+@st.cache_resource
+def get_db_lock():
+    # 多個 session 共用連線，寫入交易需互斥
+    return threading.Lock()
 
 def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute('''
+    conn = get_conn()
+    conn.execute("PRAGMA journal_mode=WAL")
+    # UNIQUE(location, forecast_date) 自帶索引，ORDER BY location, forecast_date 可直接走索引
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS forecasts (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            id INTEGER PRIMARY KEY,
             location TEXT,
             forecast_date TEXT,
             min_temp INTEGER,
@@ -57,78 +98,148 @@ def init_db():
             UNIQUE(location, forecast_date) ON CONFLICT REPLACE
         )
     ''')
-    conn.commit()
-    conn.close()
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+
+def get_meta(key):
+    with get_db_lock():
+        row = get_conn().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
 
-def save_to_db(data_list):
-    if not data_list:
+def save_to_db(df, payload_hash=None):
+    if df.empty:
         return
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    for item in data_list:
-        c.execute('''
-            INSERT INTO forecasts (location, forecast_date, min_temp, max_temp, weather_desc)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (item['地區'], item['預報日期'], item['最低溫'], item['最高溫'], item['天氣概況']))
-    conn.commit()
-    conn.close()
+    cols = df[['地區', '預報日期', '最低溫', '最高溫', '天氣概況']].astype(object)
+    rows = list(cols.itertuples(index=False, name=None))
+    conn = get_conn()
+    with get_db_lock():
+        # 單一交易批次寫入，只需一次 commit (fsync)
+        conn.execute("BEGIN")
+        try:
+            conn.executemany('''
+                INSERT INTO forecasts (location, forecast_date, min_temp, max_temp, weather_desc)
+                VALUES (?, ?, ?, ?, ?)
+            ''', rows)
+            if payload_hash is not None:
+                conn.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES ('payload_hash', ?)",
+                    (payload_hash,)
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        # 在鎖內清除快取，讀到新 hash 的 get_meta 必定也看到已清空的快取
+        get_db_data.clear()
 
+FORECASTS_QUERY = "SELECT * FROM {table} ORDER BY location, forecast_date"
+
+@st.cache_resource(show_spinner=False)
+def get_duckdb_conn():
+    # SQLite 仍是唯一的資料來源，DuckDB 透過 sqlite 擴充套件唯讀掛載查詢
+    try:
+        con = duckdb.connect()
+        # 首次執行會從 extensions.duckdb.org 下載擴充套件，之後使用本機快取
+        con.execute("INSTALL sqlite; LOAD sqlite")
+        con.execute(f"ATTACH '{os.path.abspath(DB_NAME)}' AS s (TYPE SQLITE, READ_ONLY)")
+        return con
+    except duckdb.Error:
+        # 擴充套件無法下載 (離線) 時改用其他讀取方式；失敗結果同樣被快取，
+        # 避免每次讀取都重試下載，需重啟程式才會再嘗試 DuckDB
+        return None
+
+# 可能在背景執行緒中呼叫，不顯示快取 spinner 以免與主執行緒同時寫入頁面元素
+@st.cache_data(ttl=60, show_spinner=False)
 def get_db_data():
-    conn = sqlite3.connect(DB_NAME)
-    df = pd.read_sql("SELECT * FROM forecasts ORDER BY location, forecast_date", conn)
-    conn.close()
+    duck = get_duckdb_conn()
+    query = FORECASTS_QUERY.format(table="forecasts")
+    if duck is not None:
+        # 每次查詢使用獨立 cursor，避免多執行緒共用同一個 DuckDB 連線
+        df = duck.cursor().execute(FORECASTS_QUERY.format(table="s.forecasts")).df()
+    elif cx is not None:
+        # connectorx 以原生程式碼讀取並經 Arrow 轉成 DataFrame
+        df = cx.read_sql(f"sqlite://{os.path.abspath(DB_NAME)}", query, return_type="pandas")
+    else:
+        with get_db_lock():
+            df = pd.read_sql(query, get_conn())
+    # 各讀取方式對 TIMESTAMP 欄位的型別不同，統一成 datetime64 讓表格與 CSV 輸出一致
+    df['updated_at'] = pd.to_datetime(df['updated_at'])
     return df
 
 init_db()
 
 def find_key(node, key):
-    if isinstance(node, list):
-        for i in node:
-            result = find_key(i, key)
-            if result is not None:
-                return result
-    elif isinstance(node, dict):
-        if key in node:
-            return node[key]
-        for k, v in node.items():
-            result = find_key(v, key)
-            if result is not None:
-                return result
+    # 廣度優先搜尋，避免遞迴呼叫的開銷
+    queue = deque([node])
+    while queue:
+        current = queue.popleft()
+        if isinstance(current, dict):
+            if key in current:
+                return current[key]
+            queue.extend(current.values())
+        elif isinstance(current, list):
+            queue.extend(current)
     return None
 
+WEATHER_CHAR_PATTERN = re.compile(r'[雷雨雪晴陰雲]')
+
+@lru_cache(maxsize=64)
 def get_weather_icon(desc):
     if not isinstance(desc, str): return "❓"
-    desc_clean = desc.replace(" ", "")
-    if "雷" in desc_clean: return "⛈️"
-    if "雨" in desc_clean: return "🌧️"
-    if "雪" in desc_clean: return "❄️"
-    if "晴" in desc_clean and ("雲" in desc_clean or "陰" in desc_clean): return "⛅"
-    if "晴" in desc_clean: return "☀️"
-    if "陰" in desc_clean: return "☁️"
-    if "雲" in desc_clean: return "🌥️"
+    chars = set(WEATHER_CHAR_PATTERN.findall(desc))
+    if "雷" in chars: return "⛈️"
+    if "雨" in chars: return "🌧️"
+    if "雪" in chars: return "❄️"
+    if "晴" in chars and ("雲" in chars or "陰" in chars): return "⛅"
+    if "晴" in chars: return "☀️"
+    if "陰" in chars: return "☁️"
+    if "雲" in chars: return "🌥️"
     return "🌡️"
 
-def get_temp_color(max_temp):
-    if max_temp >= 30: return [255, 87, 51]
-    elif max_temp <= 20: return [51, 193, 255]
-    else: return [117, 255, 51]
+# 氣溫分級顏色：0 舒適、1 高溫 (>=30°C)、2 低溫 (<=20°C)
+TEMP_COLORS = np.array([[117, 255, 51], [255, 87, 51], [51, 193, 255]], dtype=np.uint8)
+
+def get_temp_colors(max_temps):
+    max_temps = np.asarray(max_temps)
+    return TEMP_COLORS[np.select([max_temps >= 30, max_temps <= 20], [1, 2], default=0)]
 
 # --- 爬蟲函數 (SSL Fix) ---
-@st.cache_data(ttl=3600)
+FETCH_TTL = 3600
+
+@st.cache_resource
+def get_http_session():
+    # 磁碟快取跨行程保留回應，過期後以 ETag / If-Modified-Since 重新驗證
+    return requests_cache.CachedSession('cwa_cache', expire_after=3600, cache_control=True)
+
+@st.cache_resource
+def get_fetch_state():
+    # 記錄 fetch_and_save_weather 實際執行 (快取未命中) 的時間
+    return {'fetched_at': 0.0}
+
+@st.cache_data(ttl=FETCH_TTL)
 def fetch_and_save_weather():
+    get_fetch_state()['fetched_at'] = time.time()
     url = "https://opendata.cwa.gov.tw/fileapi/v1/opendataapi/F-A0010-001?Authorization=CWA-8DF0B9F0-1AC6-49DC-A5AD-932F40640F03&downloadType=WEB&format=JSON"
     
     try:
         urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-        response = requests.get(url, verify=False)
+        response = get_http_session().get(url, verify=False)
         response.raise_for_status()
         data = response.json()
         
-        locations = find_key(data, 'location')
+        # F-A0010-001 的結構固定，先走已知路徑，失敗才搜尋整棵樹
+        try:
+            locations = data['cwaopendata']['resources']['resource']['data']['agrWeatherForecasts']['weatherForecasts']['location']
+        except (KeyError, TypeError):
+            locations = find_key(data, 'location')
         if not locations:
-            return []
+            return pd.DataFrame()
 
-        parsed_data = []
+        frames = []
         for loc in locations:
             loc_name = loc.get('locationName', 'Unknown')
             weather_data = loc.get('weatherElements', {})
@@ -140,36 +251,117 @@ def fetch_and_save_weather():
             wx_list = weather_data.get('Wx', {}).get('daily', [])
             
             days_count = min(len(max_t_list), len(min_t_list), len(wx_list))
+            if days_count == 0:
+                continue
             
-            for i in range(days_count):
-                parsed_data.append({
-                    "地區": loc_name,
-                    "預報日期": max_t_list[i].get('dataDate', 'N/A'),
-                    "最低溫": int(min_t_list[i].get('temperature', 0)),
-                    "最高溫": int(max_t_list[i].get('temperature', 0)),
-                    "天氣概況": wx_list[i].get('weather', 'N/A')
-                })
+            df_max = pd.DataFrame(max_t_list[:days_count]).reindex(columns=['dataDate', 'temperature'])
+            df_min = pd.DataFrame(min_t_list[:days_count]).reindex(columns=['temperature'])
+            df_wx = pd.DataFrame(wx_list[:days_count]).reindex(columns=['weather'])
+            frames.append(pd.DataFrame({
+                "地區": loc_name,
+                "預報日期": df_max['dataDate'].fillna('N/A'),
+                "最低溫": df_min['temperature'].fillna(0).astype(int),
+                "最高溫": df_max['temperature'].fillna(0).astype(int),
+                "天氣概況": df_wx['weather'].fillna('N/A')
+            }))
+        
+        if not frames:
+            return pd.DataFrame()
+        parsed_data = pd.concat(frames, ignore_index=True)
         
-        save_to_db(parsed_data)
+        # 內容與上次寫入相同 (含快取 / 304 回應) 就不重寫資料庫
+        payload_hash = hashlib.blake2b(
+            parsed_data.to_json(orient='records', force_ascii=False).encode(), digest_size=16
+        ).hexdigest()
+        if get_meta('payload_hash') != payload_hash:
+            save_to_db(parsed_data, payload_hash)
         return parsed_data
         
     except Exception as e:
         st.error(f"資料抓取失敗: {e}")
-        return []
+        return pd.DataFrame()
+
+# --- 圖表建構 (依選擇快取) ---
+MAP_LAYER_COLUMNS = ['lon', 'lat', 'r', 'g', 'b', '顯示名稱', '地區', '最低溫', '最高溫', '天氣概況']
+
+@st.cache_data(max_entries=32)
+def build_temp_fig(loc, dates, mins, maxes):
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(x=dates, y=maxes, name='最高溫', line=dict(color='#FF5733')))
+    fig.add_trace(go.Scatter(x=dates, y=mins, name='最低溫', line=dict(color='#33C1FF')))
+    fig.update_layout(title=f"{loc} 氣溫走勢", template="plotly_white")
+    return fig
+
+def build_deck(df_map_json):
+    view_state = pdk.ViewState(latitude=23.6, longitude=120.9, zoom=6.8, pitch=0)
+    
+    layer = pdk.Layer(
+        "ScatterplotLayer",
+        json.loads(df_map_json),
+        get_position='[lon, lat]',
+        get_color='[r, g, b]',
+        get_radius=15000,
+        pickable=True,
+        opacity=0.8,
+        stroked=True,
+        filled=True,
+        line_width_min_pixels=1,
+        line_color=[255, 255, 255]
+    )
+    
+    tooltip = {
+        "html": "<b>{顯示名稱}</b> ({地區})<br/>氣溫: {最低溫}°C - {最高溫}°C<br/>天氣: {天氣概況}",
+        "style": {"backgroundColor": "steelblue", "color": "white"}
+    }
+    
+    # [FIX] 使用 CARTO 的開源樣式 URL，不需要 Mapbox Token
+    # 原本的 mapbox://styles/mapbox/light-v9 需要金鑰
+    return pdk.Deck(
+        layers=[layer],
+        initial_view_state=view_state,
+        tooltip=tooltip,
+        map_style="https://basemaps.cartocdn.com/gl/positron-gl-style/style.json"
+    )
+
+@st.cache_data(max_entries=16)
+def build_deck_html(df_map_json):
+    return build_deck(df_map_json).to_html(as_string=True)
+
+# 以 (筆數, 最後更新時間) 為快取鍵，底線參數不參與雜湊
+@st.cache_data(max_entries=1)
+def to_csv_bytes(df_key, _df):
+    return _df.to_csv(index=False).encode('utf-8-sig')
 
 # --- Streamlit 主程式介面 ---
 
 st.title("🌤️ 台灣一週農業氣象預報")
 st.markdown("資料來源：交通部中央氣象署 API")
 
-with st.spinner('正在同步 API 資料並寫入 SQLite data.db 資料庫...'):
+def load_db_snapshot():
+    # 先讀 hash 再讀資料，若兩者之間有寫入，hash 會不一致而觸發重讀
+    return get_meta('payload_hash'), get_db_data()
+
+if time.time() - get_fetch_state()['fetched_at'] < FETCH_TTL:
+    # API 結果仍在快取內，不會發出請求也不會寫入，直接依序讀取即可
     api_data = fetch_and_save_weather()
+    db_df = get_db_data()
+else:
+    with st.spinner('正在同步 API 資料並寫入 SQLite data.db 資料庫...'):
+        # 等待 API 回應的同時在背景執行緒讀取資料庫
+        with ThreadPoolExecutor(max_workers=1, initializer=partial(add_script_run_ctx, None, get_script_run_ctx())) as pool:
+            db_future = pool.submit(load_db_snapshot)
+            api_data = fetch_and_save_weather()
+            db_hash, db_df = db_future.result()
+        if get_meta('payload_hash') != db_hash:
+            # 背景讀到的舊資料可能已在 save_to_db 清除後才寫回快取，重讀前先清掉
+            get_db_data.clear()
+            db_df = get_db_data()
 
 tab1, tab2, tab3 = st.tabs(["📈 視覺化圖表", "🗺️ 地圖模式 (全台縣市)", "💾 本地資料庫檢視"])
 
 with tab1:
-    if api_data:
-        df = pd.DataFrame(api_data)
+    if not api_data.empty:
+        df = api_data
         st.sidebar.header("🔍 地區篩選")
         all_locations = df['地區'].unique().tolist()
         selected_loc = st.sidebar.selectbox("選擇地區", all_locations)
@@ -184,82 +376,51 @@ with tab1:
             col2.metric("氣溫範圍", f"{today_weather['最低溫']}°C - {today_weather['最高溫']}°C")
             col3.metric("天氣概況", f"{weather_icon} {today_weather['天氣概況']}")
 
-        fig = go.Figure()
-        fig.add_trace(go.Scatter(x=filtered_df['預報日期'], y=filtered_df['最高溫'], name='最高溫', line=dict(color='#FF5733')))
-        fig.add_trace(go.Scatter(x=filtered_df['預報日期'], y=filtered_df['最低溫'], name='最低溫', line=dict(color='#33C1FF')))
-        fig.update_layout(title=f"{selected_loc} 氣溫走勢", template="plotly_white")
+        series = filtered_df[['預報日期', '最高溫', '最低溫']].to_dict('list')
+        fig = build_temp_fig(selected_loc, tuple(series['預報日期']), tuple(series['最低溫']), tuple(series['最高溫']))
         st.plotly_chart(fig, use_container_width=True)
     else:
         st.warning("目前沒有資料，請檢查網路連線。")
 
 # --- Tab 2: 地圖模式區 (修改樣式) ---
-with tab2:
+# 以 fragment 包住地圖，切換日期時只重跑這一區，不重建其他分頁
+@st.fragment
+def render_map_tab(api_data):
     st.header("🗺️ 全台氣溫分佈圖")
-    if api_data:
-        df_source = pd.DataFrame(api_data)
+    if not api_data.empty:
+        df_source = api_data
         available_dates = df_source['預報日期'].unique().tolist()
         selected_date = st.selectbox("📅 選擇預報日期", available_dates)
         df_day = df_source[df_source['預報日期'] == selected_date]
         
-        map_rows = []
-        for mapping in CITY_MAPPING:
-            region_data = df_day[df_day['地區'] == mapping['region']]
-            if not region_data.empty:
-                row_data = region_data.iloc[0].to_dict()
-                row_data['顯示名稱'] = mapping['city']
-                row_data['lat'] = mapping['lat']
-                row_data['lon'] = mapping['lon']
-                row_data['color'] = get_temp_color(row_data['最高溫'])
-                map_rows.append(row_data)
+        df_map_final = CITY_MAPPING_DF.join(df_day.set_index('地區'), on='地區', how='inner')
         
-        if map_rows:
-            df_map_final = pd.DataFrame(map_rows)
-            view_state = pdk.ViewState(latitude=23.6, longitude=120.9, zoom=6.8, pitch=0)
-            
-            layer = pdk.Layer(
-                "ScatterplotLayer",
-                df_map_final,
-                get_position='[lon, lat]',
-                get_color='color',
-                get_radius=15000,
-                pickable=True,
-                opacity=0.8,
-                stroked=True,
-                filled=True,
-                line_width_min_pixels=1,
-                line_color=[255, 255, 255]
-            )
-            
-            tooltip = {
-                "html": "<b>{顯示名稱}</b> ({地區})<br/>氣溫: {最低溫}°C - {最高溫}°C<br/>天氣: {天氣概況}",
-                "style": {"backgroundColor": "steelblue", "color": "white"}
-            }
-            
-            # [FIX] 使用 CARTO 的開源樣式 URL，不需要 Mapbox Token
-            # 原本的 mapbox://styles/mapbox/light-v9 需要金鑰
-            r = pdk.Deck(
-                layers=[layer],
-                initial_view_state=view_state,
-                tooltip=tooltip,
-                map_style="https://basemaps.cartocdn.com/gl/positron-gl-style/style.json"
-            )
-            st.pydeck_chart(r)
+        if not df_map_final.empty:
+            df_map_final['r'], df_map_final['g'], df_map_final['b'] = get_temp_colors(df_map_final['最高溫']).T
+            # 只送出圖層與 tooltip 需要的欄位，縮小傳到瀏覽器的資料量；
+            # 直接嵌入 deck 的 HTML，略過 st.pydeck_chart 每次 rerun 的 proto 序列化；
+            # 代價是少了 Streamlit 內建的地圖縮放控制鈕
+            deck_html = build_deck_html(df_map_final[MAP_LAYER_COLUMNS].to_json(orient='records', force_ascii=False))
+            components.html(deck_html, height=600)
             st.markdown("""<div style="display: flex; gap: 15px; justify-content: center; margin-top: 10px;"><div><span style="color:rgb(255, 87, 51);">●</span> 高溫 (>30°C)</div><div><span style="color:rgb(117, 255, 51);">●</span> 舒適 (20-30°C)</div><div><span style="color:rgb(51, 193, 255);">●</span> 低溫 (<20°C)</div></div>""", unsafe_allow_html=True)
         else:
             st.warning("無法建立地圖資料。")
     else:
         st.info("無地圖資料")
 
+with tab2:
+    render_map_tab(api_data)
+
 with tab3:
     st.header("🗄️ SQLite 資料庫內容")
     col1, col2 = st.columns([1, 4])
     with col1:
         if st.button("🔄 重新載入資料庫"):
+            get_db_data.clear()
             st.rerun()
-    db_df = get_db_data()
     if not db_df.empty:
         st.dataframe(db_df, use_container_width=True)
-        csv = db_df.to_csv(index=False, encoding='utf-8-sig').encode('utf-8-sig')
+        csv = to_csv_bytes((len(db_df), str(db_df['updated_at'].max())), db_df)
         st.download_button(label="📥 下載資料庫 CSV", data=csv, file_name='data_db_dump.csv', mime='text/csv')
     else:
         st.info("資料庫目前是空的。")
\ No newline at end of file